@@ -22,6 +22,9 @@ class Settings(BaseSettings):
     MAX_INPUT_FILE_SIZE_MB: int = 10
     TASK_TIMEOUT_SEC: int = 1800
 
+    # Worker: сколько задач один процесс ведёт одновременно
+    WORKER_CONCURRENCY: int = 4
+
     # DB
     DATABASE_URL_ASYNC: str
     DATABASE_URL_SYNC: str
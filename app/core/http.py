@@ -0,0 +1,45 @@
+﻿from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
+import threading
+
+import httpx
+
+_RNG = threading.local()
+
+# Верхняя граница для Retry-After от сервера: кривой заголовок не подвесит воркер
+MAX_RETRY_AFTER_SEC = 60.0
+
+
+def retry_after_seconds(r: httpx.Response) -> float | None:
+    """
+    Retry-After в секундах (delta-seconds или HTTP-date), не больше MAX_RETRY_AFTER_SEC.
+    None, если заголовка нет или он не разбирается.
+    """
+    raw = (r.headers.get("Retry-After") or "").strip()
+    if not raw:
+        return None
+
+    try:
+        seconds = float(raw)
+    except ValueError:
+        try:
+            when = parsedate_to_datetime(raw)
+        except (TypeError, ValueError):
+            return None
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        seconds = (when - datetime.now(timezone.utc)).total_seconds()
+
+    return min(max(0.0, seconds), MAX_RETRY_AFTER_SEC)
+
+
+def jitter(delay: float) -> float:
+    """
+    delay ±15% для backoff. Свой Random на поток: воркеры не делят
+    глобальное состояние модуля random.
+    """
+    rng = getattr(_RNG, "rng", None)
+    if rng is None:
+        rng = _RNG.rng = random.Random()
+    return delay * (0.85 + rng.random() * 0.3)
@@ -1,12 +1,17 @@
 ﻿import enum
 from datetime import datetime
 from sqlalchemy import (
-    String, Integer, BigInteger, DateTime, Boolean, Enum, ForeignKey, Text
+    String, Integer, BigInteger, DateTime, Boolean, Enum, ForeignKey, Text, func
 )
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from app.db.base import Base
 
 
+# Время для UPDATE ставит сама БД: колонки naive UTC, поэтому now() приводим к UTC
+# (иначе при не-UTC TimeZone сессии записалось бы локальное время)
+DB_UTC_NOW = func.timezone("UTC", func.now())
+
+
 class TaskStatus(str, enum.Enum):
     queued = "queued"
     processing = "processing"
@@ -54,7 +59,13 @@ class Task(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
     preset_slug: Mapped[str] = mapped_column(String(64), default="dummy")
-    status: Mapped[TaskStatus] = mapped_column(Enum(TaskStatus), default=TaskStatus.queued, index=True)
+    # Нативный enum Postgres (тип taskstatus из 0001_init): на диске и в индексе это
+    # 4-байтовый OID, а наружу (API, бот) статус остаётся строкой
+    status: Mapped[TaskStatus] = mapped_column(
+        Enum(TaskStatus, name="taskstatus", native_enum=True),
+        default=TaskStatus.queued,
+        index=True,
+    )
 
     input_text: Mapped[str | None] = mapped_column(Text, nullable=True)
     input_tg_file_id: Mapped[str | None] = mapped_column(String(256), nullable=True)
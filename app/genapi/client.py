@@ -1,12 +1,57 @@
 ﻿from __future__ import annotations
 
-import random
+import re
 import time
+import uuid
 from dataclasses import dataclass
-from typing import Any, Mapping
+from typing import Any, BinaryIO, Mapping
 
 import httpx
 
+from app.core.http import jitter, retry_after_seconds
+
+
+# Upload content: raw bytes, an open binary file (streamed), or a path to open
+FileContent = BinaryIO | bytes | str
+UploadFiles = dict[str, tuple[str, FileContent, str]]
+
+_URL_PREFIXES = ("http://", "https://")
+
+# Status polling defaults: initial * base**n, capped. A gentle base keeps
+# polls dense in the first seconds, where most jobs finish.
+_POLL_INITIAL_DELAY_SEC = 0.1
+_POLL_BACKOFF_BASE = 1.3
+_POLL_MAX_DELAY_SEC = 10.0
+
+# Text-bearing keys, in lookup priority order
+_TOP_TEXT_KEYS = ("text", "output_text", "content", "message")
+_NESTED_TEXT_KEYS = ("content", "text", "output_text", "message")
+
+# Prefer media/output files over input/previews.
+# Priority: audio > video > images > everything else
+_PRIO_EXT = (
+    ".mp3", ".wav",
+    ".mp4", ".mov", ".webm",
+    ".png", ".jpg", ".jpeg", ".webp", ".gif",
+    ".zip",
+    ".json", ".txt",
+)
+_PRIO_EXT_RANK = {ext[1:]: i for i, ext in enumerate(_PRIO_EXT)}
+# One regex pass finds every known extension; the best rank wins
+_PRIO_EXT_RE = re.compile(r"\.(" + "|".join(_PRIO_EXT_RANK) + ")", re.IGNORECASE)
+
+_CONTROL_TOKENS: frozenset[str] = frozenset({
+    "stop",
+    "assistant",
+    "user",
+    "chat.completion",
+    "completed",
+    "success",
+    "failed",
+    "queued",
+    "processing",
+})
+
 
 @dataclass
 class GenApiResult:
@@ -27,6 +72,11 @@ class GenApiClient:
       - If there are NO files -> send JSON body (keeps booleans as booleans, fixes 422 validation).
       - If files exist        -> send multipart/form-data (convert primitives to strings).
       - Retries on transient errors (5xx, 419) for both submit and poll.
+      - Honors Retry-After when the server sends it, otherwise backs off exponentially.
+      - Every submit carries one Idempotency-Key reused across its retries, so a retry
+        after a lost response maps to the same request_id instead of a second job.
+      - One pooled httpx.Client per instance: submits and polls reuse keep-alive
+        connections. Share the instance and call close() when done.
     """
 
     def __init__(
@@ -39,6 +89,9 @@ class GenApiClient:
         max_submit_retries: int = 6,
         max_poll_retries: int = 6,
         poll_timeout_sec: int = 240,
+        poll_initial: float = _POLL_INITIAL_DELAY_SEC,
+        poll_backoff_base: float = _POLL_BACKOFF_BASE,
+        poll_max: float = _POLL_MAX_DELAY_SEC,
     ):
         self.base_url = base_url.rstrip("/")
         self.headers = {"Authorization": f"Bearer {token}"}
@@ -50,72 +103,113 @@ class GenApiClient:
         self.max_poll_retries = max_poll_retries
         self.default_poll_timeout_sec = poll_timeout_sec
 
+        self.poll_initial = poll_initial
+        self.poll_backoff_base = poll_backoff_base
+        self.poll_max = poll_max
+
+        # timeouts are set per request (submit vs poll);
+        # HTTP/2 lets concurrent tasks' polls share one connection
+        self._client = httpx.Client(
+            http2=True,
+            trust_env=False,
+            limits=httpx.Limits(max_keepalive_connections=32),
+        )
+
+    def close(self) -> None:
+        self._client.close()
+
     def submit_function(
         self,
         function_id: str,
         implementation: str,
-        files: dict[str, tuple[str, bytes, str]] | None = None,
+        files: UploadFiles | None = None,
         params: dict[str, Any] | None = None,
+        *,
+        clean: bool = True,
     ) -> int:
         url = f"{self.base_url}/functions/{function_id}"
         data = {"implementation": implementation}
-        return self._submit(url=url, base_data=data, files=files or {}, params=params)
+        return self._submit(url=url, base_data=data, files=files or {}, params=params, clean=clean)
 
     def submit_network(
         self,
         network_id: str,
-        files: dict[str, tuple[str, bytes, str]] | None = None,
+        files: UploadFiles | None = None,
         params: dict[str, Any] | None = None,
+        *,
+        clean: bool = True,
     ) -> int:
         url = f"{self.base_url}/networks/{network_id}"
-        return self._submit(url=url, base_data={}, files=files or {}, params=params)
+        return self._submit(url=url, base_data={}, files=files or {}, params=params, clean=clean)
 
-    def poll(self, request_id: int, timeout_sec: int | None = None) -> GenApiResult:
+    def poll(
+        self,
+        request_id: int,
+        timeout_sec: int | None = None,
+        *,
+        initial_delay: float | None = None,
+    ) -> GenApiResult:
         """
         Long-polling:
-          - processing -> wait and retry
+          - processing -> wait and retry: initial * base**n, capped at poll_max;
+            if the job reports progress, wait for the estimated remainder instead
           - success/failed -> return parsed best output
+        Pass a larger initial_delay for networks known to be slow.
         """
         timeout_sec = timeout_sec or self.default_poll_timeout_sec
         url = f"{self.base_url}/request/get/{request_id}"
-        deadline = time.time() + timeout_sec
-
-        delay = 1.0
-
-        with httpx.Client(timeout=self.timeout_poll_http_sec, trust_env=False) as client:
-            while True:
-                if time.time() > deadline:
-                    return GenApiResult(
-                        status="failed",
-                        payload={},
-                        file_url=None,
-                        text="Timeout waiting GenAPI result",
-                    )
-
-                r = self._request_with_retry(
-                    client=client,
-                    method="GET",
-                    url=url,
-                    headers=self.headers,
-                    max_retries=self.max_poll_retries,
-                    base_delay=delay,
-                    hard_deadline=deadline,
+        started = time.time()
+        deadline = started + timeout_sec
+
+        initial = self.poll_initial if initial_delay is None else initial_delay
+        attempt = 0
+        delay = initial
+
+        while True:
+            if time.time() > deadline:
+                return GenApiResult(
+                    status="failed",
+                    payload={},
+                    file_url=None,
+                    text="Timeout waiting GenAPI result",
                 )
 
-                # non-retryable client errors
-                if r.status_code >= 400:
-                    raise RuntimeError(f"GenAPI HTTP {r.status_code} while polling {url}: {r.text}")
-
-                js = r.json()
-                status = js.get("status") or js.get("state") or "unknown"
-
-                if status in ("success", "failed"):
-                    file_url, text = _extract_best_output(js)
-                    return GenApiResult(status=status, payload=js, file_url=file_url, text=text)
-
-                # still processing
-                time.sleep(delay)
-                delay = min(delay * 1.4, 5.0)
+            r = self._request_with_retry(
+                method="GET",
+                url=url,
+                headers=self.headers,
+                timeout=self.timeout_poll_http_sec,
+                max_retries=self.max_poll_retries,
+                base_delay=delay,
+                hard_deadline=deadline,
+            )
+
+            # non-retryable client errors
+            if r.status_code >= 400:
+                raise RuntimeError(f"GenAPI HTTP {r.status_code} while polling {url}: {r.text}")
+
+            js = r.json()
+            status = js.get("status") or js.get("state") or "unknown"
+
+            if status in ("success", "failed"):
+                file_url, text = _extract_best_output(js)
+                return GenApiResult(status=status, payload=js, file_url=file_url, text=text)
+
+            # still processing: wait as long as the server asks, if it says so
+            retry_after = retry_after_seconds(r)
+            if retry_after is not None:
+                _sleep_bounded(max(retry_after, 0.25), deadline)
+                continue
+
+            progress = _progress_fraction(js)
+            if progress is not None:
+                # linear estimate of the time left, but never busier than initial
+                remaining = (time.time() - started) * (1.0 - progress) / progress
+                _sleep_bounded(min(max(remaining, initial), self.poll_max), deadline)
+            else:
+                _sleep_bounded(delay, deadline)
+            attempt += 1
+            delay = min(initial * self.poll_backoff_base ** attempt, self.poll_max)
 
     # --------------------------
     # Internals
@@ -125,42 +219,47 @@ class GenApiClient:
         self,
         url: str,
         base_data: dict[str, Any],
-        files: dict[str, tuple[str, bytes, str]],
+        files: UploadFiles,
         params: dict[str, Any] | None,
+        *,
+        clean: bool = True,
     ) -> int:
-        # Merge and clean payload
-        payload: dict[str, Any] = dict(base_data)
-        if params:
-            payload.update(params)
-
-        payload = _clean_payload(payload)
+        # Merge and clean payload (clean=False: caller guarantees no None/empty values)
+        payload: dict[str, Any] = {**base_data, **(params or {})}
+        if clean:
+            payload = _clean_payload(payload)
 
         has_files = bool(files)
-        timeout = self.timeout_submit_sec
+        headers = {**self.headers, "Idempotency-Key": uuid.uuid4().hex}
 
-        with httpx.Client(timeout=timeout, trust_env=False) as client:
+        opened: list[BinaryIO] = []
+        try:
             if not has_files:
                 # ✅ JSON keeps types (bool stays bool)
                 r = self._request_with_retry(
-                    client=client,
                     method="POST",
                     url=url,
-                    headers=self.headers,
+                    headers=headers,
+                    timeout=self.timeout_submit_sec,
                     json=payload,
                     max_retries=self.max_submit_retries,
                 )
             else:
-                # multipart/form-data: values must be strings/bytes
+                # multipart/form-data: values must be strings/bytes,
+                # file objects are streamed by httpx instead of buffered
                 form = _to_form_fields(payload)
                 r = self._request_with_retry(
-                    client=client,
                     method="POST",
                     url=url,
-                    headers=self.headers,
+                    headers=headers,
+                    timeout=self.timeout_submit_sec,
                     data=form,
-                    files=files,
+                    files=_open_files(files, opened),
                     max_retries=self.max_submit_retries,
                 )
+        finally:
+            for fh in opened:
+                fh.close()
 
         if r.status_code >= 400:
             raise RuntimeError(f"GenAPI HTTP {r.status_code} for {url}: {r.text}")
@@ -174,10 +273,10 @@ class GenApiClient:
     def _request_with_retry(
         self,
         *,
-        client: httpx.Client,
         method: str,
         url: str,
         headers: Mapping[str, str],
+        timeout: float,
         max_retries: int,
         base_delay: float = 1.0,
         hard_deadline: float | None = None,
@@ -188,22 +287,31 @@ class GenApiClient:
           - 5xx (500, 502, 503, 504)
           - 419 (rate limit)
           - network errors (timeouts, connection)
-        Uses exponential backoff with small jitter.
+        Sleeps for Retry-After if the response has it,
+        otherwise uses exponential backoff with small jitter.
         """
         delay = max(0.6, float(base_delay))
         last_exc: Exception | None = None
 
         for attempt in range(max_retries + 1):
-            if hard_deadline is not None and time.time() > hard_deadline:
-                break
+            request_timeout = timeout
+            if hard_deadline is not None:
+                remaining = hard_deadline - time.time()
+                if remaining <= 0:
+                    break
+                # The transport enforces the deadline on the in-flight request,
+                # so a slow response can't overrun it by a whole HTTP timeout.
+                request_timeout = min(timeout, remaining)
 
             try:
-                r = client.request(method, url, headers=headers, **kwargs)
+                _rewind_files(kwargs.get("files"))
+                r = self._client.request(method, url, headers=headers, timeout=request_timeout, **kwargs)
 
                 if r.status_code in (419, 500, 502, 503, 504):
                     if attempt == max_retries:
                         return r
-                    sleep_for = _jitter(delay)
+                    retry_after = retry_after_seconds(r)
+                    sleep_for = max(retry_after, 0.25) if retry_after is not None else jitter(delay)
                     _sleep_bounded(sleep_for, hard_deadline)
                     delay = min(delay * 1.6, 10.0)
                     continue
@@ -215,7 +323,7 @@ class GenApiClient:
                 if attempt == max_retries:
                     break
 
-                sleep_for = _jitter(delay)
+                sleep_for = jitter(delay)
                 _sleep_bounded(sleep_for, hard_deadline)
                 delay = min(delay * 1.6, 10.0)
 
@@ -252,8 +360,39 @@ def _to_form_fields(payload: dict[str, Any]) -> dict[str, str]:
     return out
 
 
-def _jitter(x: float) -> float:
-    return x * (0.85 + random.random() * 0.30)
+def _open_files(files: UploadFiles, opened: list[BinaryIO]) -> dict[str, tuple[str, BinaryIO | bytes, str]]:
+    """
+    Path contents are opened for streaming; handles are appended to `opened`
+    so the caller can close them. bytes / file objects pass through as is.
+    """
+    out: dict[str, tuple[str, BinaryIO | bytes, str]] = {}
+    for field, (filename, content, mime) in files.items():
+        if isinstance(content, str):
+            fh = open(content, "rb")
+            opened.append(fh)
+            content = fh
+        out[field] = (filename, content, mime)
+    return out
+
+
+def _rewind_files(files: Mapping[str, tuple[str, Any, str]] | None) -> None:
+    # A retried multipart upload must re-read file objects from the start
+    if not files:
+        return
+    for _, content, _ in files.values():
+        if hasattr(content, "seek"):
+            content.seek(0)
+
+
+def _progress_fraction(js: dict[str, Any]) -> float | None:
+    # "progress" as 0..1 or 0..100; None when absent, unusable or not started.
+    # Exact types: bool is an int subclass and must not count as progress
+    p = js.get("progress")
+    if type(p) is not int and type(p) is not float:
+        return None
+    if p > 1:
+        p = p / 100.0
+    return p if 0 < p < 1 else None
 
 
 def _sleep_bounded(seconds: float, hard_deadline: float | None) -> None:
@@ -277,88 +416,74 @@ def _extract_best_output(payload: dict) -> tuple[str | None, str | None]:
     # 1) Prefer OpenAI-like structure (Grok / chat.completion style)
     try:
         ch = payload.get("choices")
-        if isinstance(ch, list) and ch:
-            m = ch[0].get("message") if isinstance(ch[0], dict) else None
-            if isinstance(m, dict):
+        if type(ch) is list and ch:
+            m = ch[0].get("message") if type(ch[0]) is dict else None
+            if type(m) is dict:
                 c = m.get("content")
-                if isinstance(c, str) and c.strip():
+                if type(c) is str and c.strip():
                     text = c.strip()
-                    file_url = _pick_best_url(_collect_urls(payload))
+                    file_url = pick_best_url(_collect_urls(payload))
                     return file_url, text
     except Exception:
         pass
 
-    # 2) Then try common explicit fields
-    for k in ("text", "output_text", "content", "message"):
-        v = payload.get(k)
-        if isinstance(v, str) and _is_meaningful_text(v):
-            file_url = _pick_best_url(_collect_urls(payload))
-            return file_url, v.strip()
+    # 2) Then try common explicit fields (most payloads have none of them)
+    if not payload.keys().isdisjoint(_TOP_TEXT_KEYS):
+        for k in _TOP_TEXT_KEYS:
+            v = payload.get(k)
+            if type(v) is str and _is_meaningful_text(v):
+                file_url = pick_best_url(_collect_urls(payload))
+                return file_url, v.strip()
 
     # 3) Fallback: deep search but ignore "control" strings
     text = _find_text_deep(payload)
-    file_url = _pick_best_url(_collect_urls(payload))
+    file_url = pick_best_url(_collect_urls(payload))
     return file_url, text
 
 
 def _collect_urls(x: Any) -> list[str]:
+    # Explicit stack instead of recursion: deep payloads cost no frames.
+    # Children are pushed in reverse so URLs come out in document order.
+    # Exact type checks: decoded JSON never contains str/dict/list subclasses.
     urls: list[str] = []
+    seen: set[str] = set()
+    stack: list[Any] = [x]
 
-    def rec(v: Any):
-        if isinstance(v, str) and (v.startswith("http://") or v.startswith("https://")):
-            urls.append(v)
-            return
-        if isinstance(v, dict):
-            for vv in v.values():
-                rec(vv)
-            return
-        if isinstance(v, list):
-            for vv in v:
-                rec(vv)
-            return
-
-    rec(x)
-    # unique keep order
-    seen = set()
-    out = []
-    for u in urls:
-        if u not in seen:
-            seen.add(u)
-            out.append(u)
-    return out
+    while stack:
+        v = stack.pop()
+        t = type(v)
+        if t is str:
+            if v[:1] == "h" and v.startswith(_URL_PREFIXES) and v not in seen:
+                seen.add(v)
+                urls.append(v)
+        elif t is dict:
+            stack.extend(reversed(list(v.values())))
+        elif t is list:
+            stack.extend(reversed(v))
+
+    return urls
 
 
-def _pick_best_url(urls: list[str]) -> str | None:
+def pick_best_url(urls: list[str]) -> str | None:
     if not urls:
         return None
+    # min() keeps the first of equal scores, like a stable sort, without sorting
+    return min(urls, key=_url_score)
+
 
-    # Prefer media/output files over input/previews.
-    # Priority: audio > video > images > everything else
-    prio_ext = [
-        ".mp3", ".wav",
-        ".mp4", ".mov", ".webm",
-        ".png", ".jpg", ".jpeg", ".webp", ".gif",
-        ".zip",
-        ".json", ".txt",
-    ]
-
-    def score(u: str) -> tuple[int, int]:
-        low = u.lower()
-        # penalize input_files / uploads references if present
-        penalty = 0
-        if "/input_files/" in low:
-            penalty += 5
-        if "/uploads/" in low:
-            penalty += 2
-        # extension priority
-        ext_rank = 999
-        for i, ext in enumerate(prio_ext):
-            if ext in low:
-                ext_rank = i
-                break
-        return (ext_rank, penalty)
-
-    return sorted(urls, key=score)[0]
+def _url_score(u: str) -> tuple[int, int]:
+    low = u.lower()
+    # penalize input_files / uploads references and cover art if present
+    penalty = 0
+    if "/input_files/" in low:
+        penalty += 5
+    if "cover" in low:
+        penalty += 5
+    if "/uploads/" in low:
+        penalty += 2
+    # extension priority
+    ext_rank = min((_PRIO_EXT_RANK[m.lower()] for m in _PRIO_EXT_RE.findall(u)), default=999)
+    return (ext_rank, penalty)
 
 
 def _is_meaningful_text(s: str) -> bool:
@@ -366,19 +491,8 @@ def _is_meaningful_text(s: str) -> bool:
     if not t:
         return False
 
-    # Drop common control tokens
-    bad = {
-        "stop",
-        "assistant",
-        "user",
-        "chat.completion",
-        "completed",
-        "success",
-        "failed",
-        "queued",
-        "processing",
-    }
-    if t.lower() in bad:
+    # Drop common control tokens (all short, so skip lowercasing long content)
+    if len(t) < 32 and t.lower() in _CONTROL_TOKENS:
         return False
 
     # too short and looks like a flag
@@ -389,30 +503,32 @@ def _is_meaningful_text(s: str) -> bool:
 
 
 def _find_text_deep(x: Any) -> str | None:
-    # Prefer known keys in nested dicts first
-    if isinstance(x, dict):
-        # direct hit keys
-        for k in ("content", "text", "output_text", "message"):
-            v = x.get(k)
-            if isinstance(v, str) and _is_meaningful_text(v):
-                return v.strip()
-        # then recurse
-        for v in x.values():
-            t = _find_text_deep(v)
-            if t:
-                return t
-        return None
+    # Same depth-first order as a recursive walk, driven by an explicit stack.
+    # Exact type checks, as in _collect_urls.
+    stack: list[Any] = [x]
+
+    while stack:
+        v = stack.pop()
+        t = type(v)
+
+        if t is dict:
+            # Prefer known keys in nested dicts first
+            for k in _NESTED_TEXT_KEYS:
+                vv = v.get(k)
+                if type(vv) is str and _is_meaningful_text(vv):
+                    return vv.strip()
+            # then descend
+            stack.extend(reversed(list(v.values())))
+            continue
 
-    if isinstance(x, list):
-        for v in x:
-            t = _find_text_deep(v)
-            if t:
-                return t
-        return None
+        if t is list:
+            stack.extend(reversed(v))
+            continue
 
-    if isinstance(x, str):
-        if x.startswith("http://") or x.startswith("https://"):
-            return None
-        return x.strip() if _is_meaningful_text(x) else None
+        if t is str:
+            if v.startswith(_URL_PREFIXES):
+                continue
+            if _is_meaningful_text(v):
+                return v.strip()
 
     return None
@@ -1,7 +1,9 @@
 ﻿from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Literal
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, Literal, Mapping
 
 
 ProviderTarget = Literal["function", "network"]
@@ -9,8 +11,14 @@ InputKind = Literal["image", "audio", "none"]
 Category = Literal["tools"]
 
 
-@dataclass(frozen=True)
+@dataclass(slots=True)
 class Preset:
+    """
+    Presets are built once at import and never mutated. No frozen=True
+    (it routes every __init__ assignment through object.__setattr__);
+    params are exposed read-only instead.
+    """
+
     slug: str
     title: str
     category: Category
@@ -19,12 +27,18 @@ class Preset:
     implementation: str | None
     input_kind: InputKind
     price_credits: int
-    params: dict
+    params: Mapping[str, Any]
 
     requires_text: bool = False
     input_hint: str = "Пришли файл."
     mode_title: str = ""
     input_field: str = "image"
+    # первая пауза между опросами статуса (None — по умолчанию клиента);
+    # долгим задачам (музыка, апскейл) — больше
+    poll_initial_delay_sec: float | None = None
+
+    def __post_init__(self) -> None:
+        self.params = MappingProxyType(dict(self.params))
 
 
 PRESETS: dict[str, Preset] = {
@@ -47,6 +61,7 @@ PRESETS: dict[str, Preset] = {
         input_field="image_url",
         input_hint="Соберу title/tags/prompt и сгенерирую трек.",
         mode_title="🎵 Suno v5",
+        poll_initial_delay_sec=2.0,
     ),
 
     # ==========================
@@ -86,6 +101,7 @@ PRESETS: dict[str, Preset] = {
         input_field="image_url",
         input_hint="Пришли изображение для апскейла x2.",
         mode_title="✨ Upscale x2",
+        poll_initial_delay_sec=2.0,
     ),
     "seedvr_x4": Preset(
         slug="seedvr_x4",
@@ -100,180 +116,95 @@ PRESETS: dict[str, Preset] = {
         input_field="image_url",
         input_hint="Пришли изображение для апскейла x4.",
         mode_title="✨ Upscale x4",
+        poll_initial_delay_sec=2.0,
     ),
+}
 
-    # ==========================
-    # IMAGES: NanoBanana + GPTImage
-    # ==========================
-    # NanoBanana create (text2img)
-    "img_nb_std_create": Preset(
-        slug="img_nb_std_create",
-        title="🍌 NanoBanana Standard • Создать",
-        category="tools",
-        provider_target="network",
-        provider_id="nano-banana",
-        implementation=None,
-        input_kind="none",
-        price_credits=0,
-        params={
-            "translate_input": False,
-            "num_images": 1,
-            "output_format": "png",
-            "resolution": "2K",
-        },
-        input_field="image_urls",
-        input_hint="Напиши промпт (можно выбрать пресет).",
-        mode_title="🍌 NB Std • Create",
-    ),
-    "img_nb_pro_create": Preset(
-        slug="img_nb_pro_create",
-        title="🍌 NanoBanana Pro • Создать",
-        category="tools",
-        provider_target="network",
-        provider_id="nano-banana-pro",
-        implementation=None,
-        input_kind="none",
-        price_credits=0,
-        params={
-            "translate_input": False,
-            "num_images": 1,
-            "output_format": "png",
-            "resolution": "2K",
-            "quality": "high",
-        },
-        input_field="image_urls",
-        input_hint="Напиши промпт (можно выбрать пресет).",
-        mode_title="🍌 NB Pro • Create",
-    ),
 
-    # NanoBanana edit (img2img), multi-image supported via input_field=image_urls
-    "img_nb_std_edit": Preset(
-        slug="img_nb_std_edit",
-        title="🍌 NanoBanana Standard • Редактировать",
-        category="tools",
-        provider_target="network",
-        provider_id="nano-banana",
-        implementation=None,
-        input_kind="image",
-        price_credits=0,
-        params={
-            "translate_input": False,
-            "num_images": 1,
-            "output_format": "png",
-            "resolution": "2K",
-        },
-        input_field="image_urls",
-        input_hint="Отправь 1–2 фото одним сообщением (альбомом), потом промпт.",
-        mode_title="🍌 NB Std • Edit",
-    ),
-    "img_nb_pro_edit": Preset(
-        slug="img_nb_pro_edit",
-        title="🍌 NanoBanana Pro • Редактировать",
-        category="tools",
-        provider_target="network",
-        provider_id="nano-banana-pro",
-        implementation=None,
-        input_kind="image",
-        price_credits=0,
-        params={
-            "translate_input": False,
-            "num_images": 1,
-            "output_format": "png",
-            "resolution": "2K",
-            "quality": "high",
-        },
-        input_field="image_urls",
-        input_hint="Отправь 1–2 фото одним сообщением (альбомом), потом промпт.",
-        mode_title="🍌 NB Pro • Edit",
-    ),
+# ==========================
+# IMAGES: NanoBanana + GPTImage
+# ==========================
+# Each engine × tier × action combination differs only in provider and a few params,
+# so the eight presets are generated from these tables.
+# ✅ важное: для gpt-image-1-5 используем image_urls (список), а не image_url;
+# NanoBanana edit принимает несколько фото через тот же image_urls.
+_IMG_ENGINES = {
+    # engine: (icon, title, short title, edit hint)
+    "nb": ("🍌", "NanoBanana", "NB", "Отправь 1–2 фото одним сообщением (альбомом), потом промпт."),
+    "gpt": ("🎨", "GPTImage", "GPT", "Отправь 1 фото, потом промпт."),
+}
 
-    # GPTImage create/edit (text2img + img2img)
-    # ✅ важное: для gpt-image-1-5 используем image_urls (список), а не image_url
-    "img_gpt_std_create": Preset(
-        slug="img_gpt_std_create",
-        title="🎨 GPTImage Standard • Создать",
-        category="tools",
-        provider_target="network",
-        provider_id="gpt-image-1-5",
-        implementation=None,
-        input_kind="none",
-        price_credits=0,
-        params={
-            "translate_input": False,
-            "num_images": 1,
-            "output_format": "png",
-            "image_size": "1024x1024",
-            "quality": "low",
-        },
-        input_field="image_urls",
-        input_hint="Напиши промпт (можно выбрать пресет).",
-        mode_title="🎨 GPT Std • Create",
-    ),
-    "img_gpt_pro_create": Preset(
-        slug="img_gpt_pro_create",
-        title="🎨 GPTImage Pro • Создать",
-        category="tools",
-        provider_target="network",
-        provider_id="gpt-image-1-5",
-        implementation=None,
-        input_kind="none",
-        price_credits=0,
-        params={
-            "translate_input": False,
-            "num_images": 1,
-            "output_format": "png",
-            "image_size": "1024x1024",
-            "quality": "medium",
-        },
-        input_field="image_urls",
-        input_hint="Напиши промпт (можно выбрать пресет).",
-        mode_title="🎨 GPT Pro • Create",
-    ),
-    "img_gpt_std_edit": Preset(
-        slug="img_gpt_std_edit",
-        title="🎨 GPTImage Standard • Редактировать",
-        category="tools",
-        provider_target="network",
-        provider_id="gpt-image-1-5",
-        implementation=None,
-        input_kind="image",
-        price_credits=0,
-        params={
-            "translate_input": False,
-            "num_images": 1,
-            "output_format": "png",
-            "image_size": "1024x1024",
-            "quality": "low",
-        },
-        input_field="image_urls",
-        input_hint="Отправь 1 фото, потом промпт.",
-        mode_title="🎨 GPT Std • Edit",
-    ),
-    "img_gpt_pro_edit": Preset(
-        slug="img_gpt_pro_edit",
-        title="🎨 GPTImage Pro • Редактировать",
+_IMG_TIERS = {
+    # (engine, tier): (provider_id, engine-specific params)
+    ("nb", "std"): ("nano-banana", {"resolution": "2K"}),
+    ("nb", "pro"): ("nano-banana-pro", {"resolution": "2K", "quality": "high"}),
+    ("gpt", "std"): ("gpt-image-1-5", {"image_size": "1024x1024", "quality": "low"}),
+    ("gpt", "pro"): ("gpt-image-1-5", {"image_size": "1024x1024", "quality": "medium"}),
+}
+
+_IMG_TIER_TITLES = {"std": ("Standard", "Std"), "pro": ("Pro", "Pro")}
+_IMG_ACTION_TITLES = {"create": ("Создать", "Create"), "edit": ("Редактировать", "Edit")}
+
+
+def _img_preset(engine: str, tier: str, action: str) -> Preset:
+    icon, engine_title, engine_short, edit_hint = _IMG_ENGINES[engine]
+    provider_id, extra_params = _IMG_TIERS[(engine, tier)]
+    tier_title, tier_short = _IMG_TIER_TITLES[tier]
+    action_title, action_short = _IMG_ACTION_TITLES[action]
+    is_edit = action == "edit"
+
+    return Preset(
+        slug=f"img_{engine}_{tier}_{action}",
+        title=f"{icon} {engine_title} {tier_title} • {action_title}",
         category="tools",
         provider_target="network",
-        provider_id="gpt-image-1-5",
+        provider_id=provider_id,
         implementation=None,
-        input_kind="image",
+        input_kind="image" if is_edit else "none",
         price_credits=0,
         params={
             "translate_input": False,
             "num_images": 1,
             "output_format": "png",
-            "image_size": "1024x1024",
-            "quality": "medium",
+            **extra_params,
         },
         input_field="image_urls",
-        input_hint="Отправь 1 фото, потом промпт.",
-        mode_title="🎨 GPT Pro • Edit",
-    ),
-}
+        input_hint=edit_hint if is_edit else "Напиши промпт (можно выбрать пресет).",
+        mode_title=f"{icon} {engine_short} {tier_short} • {action_short}",
+    )
+
+
+def _img_presets() -> dict[str, Preset]:
+    out: dict[str, Preset] = {}
+    for engine in _IMG_ENGINES:
+        for action in _IMG_ACTION_TITLES:
+            for tier in _IMG_TIER_TITLES:
+                preset = _img_preset(engine, tier, action)
+                out[preset.slug] = preset
+    return out
+
+
+PRESETS.update(_img_presets())
+
+
+def _check_canonical_keys(presets: dict[str, Preset]) -> None:
+    # get_preset's one-lookup path relies on keys being canonical slugs
+    for key, preset in presets.items():
+        if key != key.strip().lower() or key != preset.slug:
+            raise RuntimeError(f"Preset key is not canonical: {key!r} (slug={preset.slug!r})")
+
+
+_check_canonical_keys(PRESETS)
 
 
+@lru_cache(maxsize=256)
 def get_preset(slug: str) -> Preset:
-    slug = (slug or "").strip().lower()
-    if slug not in PRESETS:
+    # PRESETS never changes at runtime, so lookups are safe to cache per raw slug
+    # (callers normally pass the canonical one). Misses raise and are not cached.
+    preset = PRESETS.get(slug)
+    if preset is None:
+        slug = (slug or "").strip().lower()
+        preset = PRESETS.get(slug)
+    if preset is None:
         raise KeyError(f"Preset not found: {slug}")
-    return PRESETS[slug]
+    return preset
@@ -2,52 +2,71 @@
 import time
 from datetime import datetime
 
-from sqlalchemy import select, update
-from app.db.session import SessionLocal
-from app.db.models import User, Balance, Task, TaskStatus
+from boto3.s3.transfer import TransferConfig
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert
+from app.db.session import ScopedSession
+from app.db.models import DB_UTC_NOW, User, Balance, Task, TaskStatus
 from app.storage.minio import s3_client, ensure_bucket
 from app.core.config import settings
 
 
 def _get_or_create_user_and_balance(db, tg_user_id: int) -> int:
-    user = db.execute(select(User).where(User.tg_user_id == tg_user_id)).scalar_one_or_none()
-    if not user:
-        user = User(tg_user_id=tg_user_id, created_at=datetime.utcnow())
-        db.add(user)
-        db.flush()
-        bal = Balance(user_id=user.id, credits=0)
-        db.add(bal)
-        db.flush()
-    return user.id
+    # Upsert вместо SELECT + INSERT + flush: два запроса на любой исход.
+    # DO UPDATE (а не DO NOTHING), чтобы RETURNING отдал id и для существующего юзера.
+    user_id = db.execute(
+        insert(User)
+        .values(tg_user_id=tg_user_id, created_at=datetime.utcnow())
+        .on_conflict_do_update(index_elements=[User.tg_user_id], set_={"tg_user_id": tg_user_id})
+        .returning(User.id)
+    ).scalar_one()
+    db.execute(
+        insert(Balance)
+        .values(user_id=user_id, credits=0)
+        .on_conflict_do_nothing(index_elements=[Balance.user_id])
+    )
+    return user_id
+
+
+_DUMMY_RESULT_TMPL = b"Dummy result for task=%d\nInput text: %s\n"
+
+# Мелкие результаты уходят одним PUT, крупные — параллельными multipart-частями
+_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=4, use_threads=True)
 
 
 def process_dummy_task(task_id: int) -> None:
-    # 1) помечаем processing
-    db = SessionLocal()
+    # 1) забираем задачу: queued -> processing и input_text одним UPDATE ... RETURNING.
+    # Статус в БД, а не только в RQ: цикл app.worker.main берёт queued-задачи,
+    # и без него та же задача выполнилась бы второй раз
+    db = ScopedSession()
     try:
-        task = db.execute(select(Task).where(Task.id == task_id)).scalar_one()
-        db.execute(
+        row = db.execute(
             update(Task)
-            .where(Task.id == task_id)
-            .values(status=TaskStatus.processing, updated_at=datetime.utcnow(), error_message=None)
-        )
+            .where(Task.id == task_id, Task.status == TaskStatus.queued)
+            .values(status=TaskStatus.processing, updated_at=DB_UTC_NOW)
+            .returning(Task.input_text)
+        ).one_or_none()
+        # коммитим сразу: не держим соединение idle in transaction на время работы
         db.commit()
+        if row is None:
+            return  # уже забрана другим исполнителем
+        input_text = row.input_text
 
         # 2) имитация работы
         time.sleep(2)
 
         # 3) создаём dummy файл
-        content = f"Dummy result for task={task_id}\nInput text: {task.input_text}\n"
-        buf = io.BytesIO(content.encode("utf-8"))
+        body = _DUMMY_RESULT_TMPL % (task_id, str(input_text).encode("utf-8"))
         key = f"results/task_{task_id}.txt"
 
         ensure_bucket()
         s3 = s3_client()
-        s3.put_object(
-            Bucket=settings.MINIO_BUCKET,
-            Key=key,
-            Body=buf.getvalue(),
-            ContentType="text/plain",
+        s3.upload_fileobj(
+            io.BytesIO(body),
+            settings.MINIO_BUCKET,
+            key,
+            Config=_TRANSFER_CONFIG,
+            ExtraArgs={"ContentType": "text/plain"},
         )
 
         # 4) обновляем task success
@@ -58,7 +77,7 @@ def process_dummy_task(task_id: int) -> None:
                 status=TaskStatus.success,
                 result_file_key=key,
                 result_text="Готово ✅ (dummy)",
-                updated_at=datetime.utcnow(),
+                updated_at=DB_UTC_NOW,
             )
         )
         db.commit()
@@ -70,9 +89,9 @@ def process_dummy_task(task_id: int) -> None:
             .values(
                 status=TaskStatus.failed,
                 error_message=str(e),
-                updated_at=datetime.utcnow(),
+                updated_at=DB_UTC_NOW,
             )
         )
         db.commit()
     finally:
-        db.close()
+        ScopedSession.remove()
@@ -5,9 +5,12 @@ from app.core.config import settings
 
 listen = [settings.RQ_QUEUE_NAME]
 
+# Общий пул соединений процесса: и воркер, и код задач берут соединения отсюда
+POOL = redis.ConnectionPool.from_url(settings.REDIS_URL, max_connections=32, socket_keepalive=True)
+
 
 def main():
-    redis_conn = redis.from_url(settings.REDIS_URL)
+    redis_conn = redis.Redis(connection_pool=POOL)
     with Connection(redis_conn):
         worker = Worker(map(Queue, listen))
         worker.work(with_scheduler=False)
@@ -1,28 +1,79 @@
 ﻿from pathlib import Path
+import os
+import shutil
+import tempfile
+from typing import BinaryIO, Iterable
 
 DATA_DIR = Path("./data")
 FILES_DIR = DATA_DIR / "files"
 
+COPY_CHUNK_SIZE = 1 << 20
+
+# Каталоги, уже созданные этим процессом: повторный mkdir не нужен
+_DIRS_READY: set[Path] = set()
+
+_SLASH_TR = str.maketrans("\\", "/")
+
 
 def ensure_dirs() -> None:
-    FILES_DIR.mkdir(parents=True, exist_ok=True)
+    _ensure_dir(FILES_DIR)
+
+
+def _safe_key(key: str) -> str:
+    # Обратные слэши в ключах редкость: без них обходимся одним strip
+    if "\\" not in key:
+        return key.strip("/")
+    return key.translate(_SLASH_TR).strip("/")
+
 
+def _ensure_dir(path: Path) -> None:
+    if path in _DIRS_READY:
+        return
+    path.mkdir(parents=True, exist_ok=True)
+    _DIRS_READY.add(path)
 
-def save_bytes(key: str, data: bytes) -> str:
+
+def save_bytes(key: str, data: bytes | bytearray | memoryview | Iterable[bytes]) -> str:
     """
     key: например "results/task_1.txt"
     Сохраняем в ./data/files/results/task_1.txt
+    Пишет через save_stream: путь записи один и атомарный.
     """
-    ensure_dirs()
-    safe_key = key.strip("/").replace("\\", "/")
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = (data,)
+    return save_stream(key, data)
+
+
+def save_stream(key: str, src: BinaryIO | Iterable[bytes]) -> str:
+    """
+    Как save_bytes, но пишет кусками из файлового объекта
+    или итератора чанков (например, тела HTTP-ответа),
+    не собирая всё содержимое в памяти.
+    Пишем во временный файл рядом и переименовываем: оборванная загрузка
+    не оставит по ключу недописанный файл.
+    """
+    safe_key = _safe_key(key)
     path = FILES_DIR / safe_key
-    path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_bytes(data)
+    _ensure_dir(path.parent)
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=f".{path.name}.", suffix=".part", delete=False) as dst:
+        try:
+            if hasattr(src, "read"):
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+            else:
+                for chunk in src:
+                    dst.write(chunk)
+        except BaseException:
+            dst.close()
+            os.unlink(dst.name)
+            raise
+    # mkstemp создаёт 0600, а файлы раздаёт API — права как у обычного open()
+    os.chmod(dst.name, 0o644)
+    os.replace(dst.name, path)
     return safe_key
 
 
 def read_bytes(key: str) -> bytes:
     ensure_dirs()
-    safe_key = key.strip("/").replace("\\", "/")
+    safe_key = _safe_key(key)
     path = FILES_DIR / safe_key
     return path.read_bytes()
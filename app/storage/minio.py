@@ -1,20 +1,40 @@
-﻿import boto3
+﻿import threading
+
+import boto3
 from app.core.config import settings
 
+# One client per process: boto3 clients are thread-safe and keep their own
+# connection pool, so building one per call only costs setup and keep-alive.
+_S3 = None
+_S3_LOCK = threading.Lock()
+
+_ENSURED: set[str] = set()
+
+_ENDPOINT = f"{'https' if settings.MINIO_SECURE else 'http'}://{settings.MINIO_ENDPOINT}"
+
 
 def s3_client():
-    return boto3.client(
-        "s3",
-        endpoint_url=f"http{'s' if settings.MINIO_SECURE else ''}://{settings.MINIO_ENDPOINT}",
-        aws_access_key_id=settings.MINIO_ACCESS_KEY,
-        aws_secret_access_key=settings.MINIO_SECRET_KEY,
-        region_name="us-east-1",
-    )
+    global _S3
+    if _S3 is None:
+        with _S3_LOCK:
+            if _S3 is None:
+                _S3 = boto3.client(
+                    "s3",
+                    endpoint_url=_ENDPOINT,
+                    aws_access_key_id=settings.MINIO_ACCESS_KEY,
+                    aws_secret_access_key=settings.MINIO_SECRET_KEY,
+                    region_name="us-east-1",
+                )
+    return _S3
 
 
 def ensure_bucket():
+    # После первой успешной проверки бакет считаем существующим до конца процесса
+    if settings.MINIO_BUCKET in _ENSURED:
+        return
     s3 = s3_client()
     try:
         s3.head_bucket(Bucket=settings.MINIO_BUCKET)
     except Exception:
         s3.create_bucket(Bucket=settings.MINIO_BUCKET)
+    _ENSURED.add(settings.MINIO_BUCKET)
@@ -26,7 +26,7 @@ def _check_required(settings) -> None:
 
 
 def _compile_all() -> None:
-    if not compileall.compile_dir("app", quiet=1):
+    if not compileall.compile_dir("app", quiet=1, workers=0):
         raise SystemExit("compileall failed")
 
 
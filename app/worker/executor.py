@@ -1,22 +1,78 @@
 ﻿from __future__ import annotations
 
-from datetime import datetime, UTC
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
+import atexit
 import mimetypes
-import json
+import re
 import time
-import random
 import logging
+from urllib.parse import urlsplit
 
 import httpx
-from sqlalchemy import select, update
+import orjson
+from sqlalchemy import bindparam, select, update
 
 from app.core.config import settings
-from app.db.models import Task, TaskStatus
+from app.core.http import jitter, retry_after_seconds
+from app.db.models import DB_UTC_NOW, Task, TaskStatus
 from app.db.session import SessionLocal
-from app.genapi.client import GenApiClient
+from app.genapi.client import GenApiClient, pick_best_url
 from app.presets.registry import get_preset
-from app.storage.local import save_bytes
-from app.worker.telegram_files import tg_download_file
+from app.storage.local import save_stream
+from app.worker.telegram_files import tg_download_file, tg_stream_file
+
+
+_TASK_LOG = logging.getLogger("task_events")
+_LOG = logging.getLogger(__name__)
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# настройки не меняются в рамках процесса — разбираем один раз
+_PUBLIC_BASE = str(settings.API_PUBLIC_BASE_URL).rstrip("/")
+_BOT_TOKEN = settings.BOT_TOKEN
+_GENAPI_TOKEN = settings.GENAPI_TOKEN
+_TASK_TIMEOUT_SEC = settings.TASK_TIMEOUT_SEC
+_MAX_INPUT_FILES = settings.MAX_INPUT_FILES
+_MAX_INPUT_FILE_SIZE_MB = settings.MAX_INPUT_FILE_SIZE_MB
+_INPUT_LIMIT_BYTES = int(_MAX_INPUT_FILE_SIZE_MB) * 1024 * 1024
+
+# таблица mime читается один раз при импорте, а не на первой задаче
+mimetypes.init()
+
+# расширения входных файлов из Telegram (без точки)
+_INPUT_EXTS = frozenset({"png", "jpg", "jpeg", "webp", "gif", "mp3", "wav", "mp4", "mov", "webm"})
+# расширения результата (без точки), определяются по path url
+_RESULT_EXTS = frozenset({"mp3", "wav", "mp4", "mov", "webm", "png", "jpg", "jpeg", "webp", "gif", "txt", "json"})
+
+# общий клиент на процесс воркера: keep-alive к CDN GenAPI между задачами,
+# по HTTP/2 параллельные скачивания мультиплексируются в одном соединении.
+# http2/limits задаются на транспорте: при явном transport клиент их игнорирует;
+# retries — повтор неудачного соединения прямо в транспорте, без нашего цикла
+_HTTP = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0),
+    ),
+    timeout=httpx.Timeout(60.0, connect=30.0),
+    trust_env=False,
+    follow_redirects=True,
+)
+atexit.register(_HTTP.close)
+
+# общий на процесс пул скачиваний из Telegram: параллельных запросов к Bot API
+# не больше 6 суммарно по всем задачам (у Telegram лимит ~10 одновременных)
+TG_DOWNLOAD_CONCURRENCY = 6
+_TG_POOL = ThreadPoolExecutor(max_workers=TG_DOWNLOAD_CONCURRENCY, thread_name_prefix="tg")
+
+# один клиент GenAPI на процесс: submit и poll всех задач идут по общим соединениям
+_GEN = GenApiClient(
+    settings.GENAPI_BASE_URL,
+    _GENAPI_TOKEN,
+    poll_timeout_sec=_TASK_TIMEOUT_SEC,
+)
+atexit.register(_GEN.close)
 
 
 def _log_task_event(
@@ -28,7 +84,10 @@ def _log_task_event(
     result_file_key: str | None,
     error_message: str | None,
 ) -> None:
-    logger = logging.getLogger("task_events")
+    # уровень проверяем при вызове: логирование настраивается после импорта.
+    # isEnabledFor кэшируется в logging, так что это дешевле сериализации
+    if not _TASK_LOG.isEnabledFor(logging.INFO):
+        return
     try:
         payload = {
             "event": event,
@@ -38,9 +97,9 @@ def _log_task_event(
             "result_file_key": result_file_key,
             "error_message": error_message,
         }
-        logger.info("task_event=%s", json.dumps(payload, ensure_ascii=False))
+        _TASK_LOG.info("task_event=%s", orjson.dumps(payload).decode())
     except Exception:
-        logging.getLogger(__name__).warning("Failed to log task event", exc_info=True)
+        _LOG.warning("Failed to log task event", exc_info=True)
 
 
 def _guess_mime(filename: str) -> str:
@@ -53,142 +112,194 @@ def _parse_text_and_meta(input_text: str | None) -> tuple[str, dict]:
         return "", {}
     raw = str(input_text)
 
-    sep = "\n---\n"
-    if sep not in raw:
+    prompt, sep, meta_raw = raw.partition("\n---\n")
+    if not sep:
         return raw.strip(), {}
 
-    prompt, meta_raw = raw.split(sep, 1)
-    prompt = prompt.strip()
-
-    meta = {}
     try:
-        meta = json.loads(meta_raw.strip())
-        if not isinstance(meta, dict):
+        meta = orjson.loads(meta_raw)
+        if type(meta) is not dict:
             meta = {}
-    except Exception:
+    except orjson.JSONDecodeError:
         meta = {}
 
-    return prompt, meta
+    return prompt.strip(), meta
 
 
 def _ext_from_filename(filename: str | None) -> str:
-    low = (filename or "").lower()
-    for e in (".png", ".jpg", ".jpeg", ".webp", ".gif", ".mp3", ".wav", ".mp4", ".mov", ".webm"):
-        if low.endswith(e):
-            return e
-    return ".bin"
+    _, dot, e = (filename or "").lower().rpartition(".")
+    return f".{e}" if dot and e in _INPUT_EXTS else ".bin"
 
 
-def _download_with_retry(url: str, timeout_total: float = 300.0) -> bytes:
+def _download_to_key(url: str, key: str, timeout_total: float = 300.0) -> str:
+    """
+    Скачивает url прямо в хранилище под ключом key, кусками по 1 МБ,
+    без промежуточного bytes на весь файл. При повторе файл перезаписывается.
+    """
     deadline = time.time() + timeout_total
     delay = 1.0
 
-    with httpx.Client(timeout=httpx.Timeout(60.0, connect=30.0), trust_env=False, follow_redirects=True) as client:
-        while True:
-            try:
-                r = client.get(url)
+    while True:
+        try:
+            with _HTTP.stream("GET", url) as r:
                 if r.status_code in (500, 502, 503, 504, 429):
                     if time.time() > deadline:
+                        r.read()
                         raise RuntimeError(f"Download failed by deadline: HTTP {r.status_code} {r.text[:200]}")
-                    time.sleep(delay * (0.85 + random.random() * 0.3))
-                    delay = min(delay * 1.6, 8.0)
-                    continue
-
-                r.raise_for_status()
-                return r.content
-
-            except (httpx.TimeoutException, httpx.NetworkError) as e:
-                if time.time() > deadline:
-                    raise RuntimeError(f"Download failed by deadline: {e}") from e
-                time.sleep(delay * (0.85 + random.random() * 0.3))
-                delay = min(delay * 1.6, 8.0)
-
-
-def _collect_urls(x) -> list[str]:
-    urls: list[str] = []
-
-    def rec(v):
-        if isinstance(v, str) and (v.startswith("http://") or v.startswith("https://")):
-            urls.append(v)
-            return
-        if isinstance(v, dict):
-            for vv in v.values():
-                rec(vv)
-            return
-        if isinstance(v, list):
-            for vv in v:
-                rec(vv)
-            return
-
-    rec(x)
-    seen = set()
-    out = []
-    for u in urls:
-        if u not in seen:
-            seen.add(u)
-            out.append(u)
-    return out
-
-
-def _pick_best_url(urls: list[str]) -> str | None:
-    if not urls:
-        return None
-
-    prio_ext = [
-        ".mp3", ".wav",
-        ".mp4", ".mov", ".webm",
-        ".png", ".jpg", ".jpeg", ".webp", ".gif",
-        ".zip",
-    ]
-
-    def score(u: str) -> tuple[int, int]:
-        low = u.lower()
-        penalty = 0
-        if "cover" in low:
-            penalty += 5
-        if "/input_files/" in low:
-            penalty += 4
-        ext_rank = 999
-        for i, ext in enumerate(prio_ext):
-            if ext in low:
-                ext_rank = i
-                break
-        return (ext_rank, penalty)
-
-    return sorted(urls, key=score)[0]
+                    # сервер сам сказал, когда повторить — ждём ровно столько
+                    wait = retry_after_seconds(r)
+                    if wait is None:
+                        wait = jitter(delay)
+                        delay = min(delay * 1.6, 8.0)
+                else:
+                    r.raise_for_status()
+                    return save_stream(key, r.iter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE))
+
+            # спим уже после выхода из with: ответ закрыт, соединение не занято паузой
+            time.sleep(wait)
+
+        except (httpx.TimeoutException, httpx.NetworkError) as e:
+            if time.time() > deadline:
+                raise RuntimeError(f"Download failed by deadline: {e}") from e
+            time.sleep(jitter(delay))
+            delay = min(delay * 1.6, 8.0)
+
+
+_AUDIO_URL_RE = re.compile(r"\.(?:mp3|wav)", re.IGNORECASE)
+
+
+def _analyze_payload(x) -> tuple[list[str], list[str]]:
+    """
+    Один обход payload: все http(s)-url без дублей (в порядке появления)
+    и отдельно аудио-url (.mp3/.wav) из них же — для Suno.
+    """
+    # явный стек; dict как упорядоченное множество убирает дубли сразу.
+    # type() is вместо isinstance: из JSON не приходят подклассы str/dict/list
+    seen: dict[str, None] = {}
+    audio: list[str] = []
+    stack = [x]
+    while stack:
+        v = stack.pop()
+        t = type(v)
+        if t is str:
+            if v.startswith(("http://", "https://")) and v not in seen:
+                seen[v] = None
+                if _AUDIO_URL_RE.search(v):
+                    audio.append(v)
+        elif t is dict:
+            stack.extend(reversed(v.values()))
+        elif t is list:
+            stack.extend(reversed(v))
+    return list(seen), audio
 
 
 def _grok_extract_text(payload: dict) -> str | None:
     try:
         ch = payload.get("choices")
-        if isinstance(ch, list) and ch:
-            m = ch[0].get("message") if isinstance(ch[0], dict) else None
-            if isinstance(m, dict):
+        if type(ch) is list and ch:
+            m = ch[0].get("message") if type(ch[0]) is dict else None
+            if type(m) is dict:
                 c = m.get("content")
-                if isinstance(c, str) and c.strip():
+                if type(c) is str and c.strip():
                     return c.strip()
     except Exception:
         pass
     return None
 
 
-def _input_size_limit_bytes() -> int:
-    return int(settings.MAX_INPUT_FILE_SIZE_MB) * 1024 * 1024
-
-
-def _ensure_file_size(filename: str, content: bytes) -> None:
-    limit = _input_size_limit_bytes()
-    size = len(content or b"")
-    if size > limit:
+# ---- Special: Suno (network) ----
+def _apply_suno(params: ChainMap, prompt_text: str, meta: dict) -> None:
+    title = (meta.get("title") or "").strip()
+    tags = (meta.get("tags") or "").strip()
+    prompt = (meta.get("prompt") or prompt_text or "").strip()
+
+    if not title or not tags or not prompt:
+        raise RuntimeError("Suno requires title, tags, prompt")
+
+    params["title"] = title
+    params["tags"] = tags
+    params["prompt"] = prompt
+    params["model"] = "v5"
+    params["translate_input"] = False
+
+
+# ---- Special: Grok (network) ----
+def _apply_grok(params: ChainMap, prompt_text: str, meta: dict) -> None:
+    # prompt_text уже очищен в _parse_text_and_meta
+    if not prompt_text:
+        raise RuntimeError("Grok requires prompt text")
+    params["messages"] = [{"role": "user", "content": prompt_text}]
+    params.setdefault("model", "grok-4-1-fast-reasoning")
+    params.setdefault("stream", False)
+
+
+# ---- Image presets: img_* ----
+# ключи meta, которые пользователь может передать в img_* пресеты
+_ALLOWED_IMG_KEYS = frozenset({
+    "aspect_ratio",
+    "image_size",
+    "quality",
+    "resolution",
+    "num_images",
+    "output_format",
+    "translate_input",
+    "tg_file_ids",
+})
+
+
+def _apply_img_preset(params: ChainMap, prompt_text: str, meta: dict) -> None:
+    if prompt_text:
+        params["prompt"] = prompt_text
+
+    params["translate_input"] = False
+
+    if not meta:
+        return
+    for k in meta.keys() & _ALLOWED_IMG_KEYS:
+        v = meta[k]
+        if v is not None:
+            params[k] = v
+
+
+_SLUG_HANDLERS = {
+    "suno": _apply_suno,
+    "grok": _apply_grok,
+}
+
+
+# финальная запись задачи (success/failed): один statement, компилируется один раз;
+# время берёт сама БД (UTC, как в app.queue.jobs) — без datetime на стороне Python
+_UPDATE_TASK = (
+    update(Task)
+    .where(Task.id == bindparam("task_id"))
+    .values(
+        status=bindparam("new_status"),
+        result_file_key=bindparam("result_key"),
+        result_text=bindparam("result_txt"),
+        error_message=bindparam("error_msg"),
+        updated_at=DB_UTC_NOW,
+    )
+)
+
+
+def _ext_from_url(url: str) -> str:
+    # только path: query (?fmt=png, подписи) не должен влиять на расширение
+    _, dot, tail = urlsplit(url).path.rpartition(".")
+    tail = tail.lower()
+    return f".{tail}" if dot and tail in _RESULT_EXTS else ".bin"
+
+
+def _ensure_file_size(filename: str, size: int) -> None:
+    if size > _INPUT_LIMIT_BYTES:
         raise RuntimeError(
             f"Слишком большой файл {filename} ({size / 1024 / 1024:.2f} МБ). "
-            f"Лимит {settings.MAX_INPUT_FILE_SIZE_MB} МБ."
+            f"Лимит {_MAX_INPUT_FILE_SIZE_MB} МБ."
         )
 
 
 def _ensure_file_count(count: int) -> None:
-    if count > settings.MAX_INPUT_FILES:
-        raise RuntimeError(f"Слишком много файлов: максимум {settings.MAX_INPUT_FILES}.")
+    if count > _MAX_INPUT_FILES:
+        raise RuntimeError(f"Слишком много файлов: максимум {_MAX_INPUT_FILES}.")
 
 
 def execute_task(task_id: int) -> None:
@@ -197,123 +308,79 @@ def execute_task(task_id: int) -> None:
     result_file_key_for_log: str | None = None
     preset_slug = ""
     try:
-        task = db.execute(select(Task).where(Task.id == task_id)).scalar_one()
-        preset_slug = (task.preset_slug or "").strip().lower()
-        preset = get_preset(preset_slug)
-
-        db.execute(
-            update(Task)
-            .where(Task.id == task_id)
-            .values(
-                status=TaskStatus.processing,
-                updated_at=datetime.now(UTC),
-                error_message=None,
-            )
-        )
+        # задача уже переведена в processing при захвате (worker main).
+        # Берём только нужные колонки кортежем — без ORM-объекта Task и его expire.
+        raw_slug, input_text, input_tg_file_id = db.execute(
+            select(Task.preset_slug, Task.input_text, Task.input_tg_file_id).where(Task.id == task_id)
+        ).one()
+        preset_slug = (raw_slug or "").strip().lower()
+        # После commit сессия отдаёт соединение в пул и до финального UPDATE к БД
+        # не обращается — poll и скачивание результата идут без открытой транзакции.
         db.commit()
 
-        if not settings.GENAPI_TOKEN:
-            raise RuntimeError("GENAPI_TOKEN is empty in .env")
-
-        gen = GenApiClient(
-            settings.GENAPI_BASE_URL,
-            settings.GENAPI_TOKEN,
-            poll_timeout_sec=settings.TASK_TIMEOUT_SEC,
-        )
-
-        params: dict = dict(preset.params or {})
-        prompt_text, meta = _parse_text_and_meta(task.input_text)
-
-        # ---- Special: Suno (network) ----
-        if preset.slug == "suno":
-            title = (meta.get("title") or "").strip()
-            tags = (meta.get("tags") or "").strip()
-            prompt = (meta.get("prompt") or prompt_text or "").strip()
-
-            if not title or not tags or not prompt:
-                raise RuntimeError("Suno requires title, tags, prompt")
+        preset = get_preset(preset_slug)
 
-            params["title"] = title
-            params["tags"] = tags
-            params["prompt"] = prompt
-            params["model"] = "v5"
-            params["translate_input"] = False
+        if not _GENAPI_TOKEN:
+            raise RuntimeError("GENAPI_TOKEN is empty in .env")
 
-        # ---- Special: Grok (network) ----
-        if preset.slug == "grok":
-            user_prompt = (prompt_text or "").strip()
-            if not user_prompt:
-                raise RuntimeError("Grok requires prompt text")
-            params["messages"] = [{"role": "user", "content": user_prompt}]
-            params.setdefault("model", "grok-4-1-fast-reasoning")
-            params.setdefault("stream", False)
+        gen = _GEN
+        # записи идут в верхний dict, дефолты пресета не копируются
+        params: ChainMap = ChainMap({}, preset.params)
+        prompt_text, meta = _parse_text_and_meta(input_text)
 
-        # ---- Image presets: img_* ----
+        # ---- preset-specific params ----
         if preset.slug.startswith("img_"):
-            if prompt_text:
-                params["prompt"] = prompt_text
-
-            params["translate_input"] = False
-
-            allowed = {
-                "aspect_ratio",
-                "image_size",
-                "quality",
-                "resolution",
-                "num_images",
-                "output_format",
-                "translate_input",
-                "tg_file_ids",
-            }
-            for k, v in (meta or {}).items():
-                if k in allowed and v is not None:
-                    params[k] = v
-
-        # ---- download single file if needed by functions ----
-        filename = content = mime = None
-        if preset.provider_target == "function" and preset.input_kind != "none":
-            if not task.input_tg_file_id:
-                raise RuntimeError("No input file. Send image/audio file.")
-            filename, content = tg_download_file(settings.BOT_TOKEN, task.input_tg_file_id)
-            _ensure_file_size(filename, content)
-            mime = _guess_mime(filename)
+            _apply_img_preset(params, prompt_text, meta)
+        else:
+            handler = _SLUG_HANDLERS.get(preset.slug)
+            if handler is not None:
+                handler(params, prompt_text, meta)
 
         # ---- run ----
         if preset.provider_target == "function":
-            files = None
+            # входной файл скачивается ровно один раз и сразу уходит в multipart
+            files = {}
             if preset.input_kind != "none":
-                files = {preset.input_field: (filename, content, mime)}
+                if not input_tg_file_id:
+                    raise RuntimeError("No input file. Send image/audio file.")
+                filename, content = tg_download_file(_BOT_TOKEN, input_tg_file_id)
+                _ensure_file_size(filename, len(content or b""))
+                files[preset.input_field] = (filename, content, _guess_mime(filename))
 
             request_id = gen.submit_function(
                 function_id=preset.provider_id,
                 implementation=preset.implementation or "default",
-                files=files or {},
-                params=params,
+                files=files,
+                params=dict(params),
             )
 
         elif preset.provider_target == "network":
             if preset.input_kind != "none":
                 tg_file_ids: list[str] = []
                 v = (meta or {}).get("tg_file_ids")
-                if isinstance(v, list):
+                if type(v) is list:
                     tg_file_ids = [str(x) for x in v if x]
 
                 if not tg_file_ids:
-                    if not task.input_tg_file_id:
+                    if not input_tg_file_id:
                         raise RuntimeError("No input file. Send image file.")
-                    tg_file_ids = [task.input_tg_file_id]
+                    tg_file_ids = [input_tg_file_id]
 
                 _ensure_file_count(len(tg_file_ids))
 
-                public_base = str(settings.API_PUBLIC_BASE_URL).rstrip("/")
-                urls: list[str] = []
-                for idx, fid in enumerate(tg_file_ids, start=1):
-                    fn, body = tg_download_file(settings.BOT_TOKEN, fid)
-                    _ensure_file_size(fn, body)
-                    ext = _ext_from_filename(fn)
-                    input_key = f"uploads/task_{task_id}_{preset.slug}_{idx}{ext}"
-                    save_bytes(input_key, body)
-                    urls.append(f"{public_base}/files/{input_key}")
+                def _fetch(item: tuple[int, str]) -> tuple[str, str, int]:
+                    idx, fid = item
+                    return tg_stream_file(
+                        _BOT_TOKEN,
+                        fid,
+                        lambda name: f"uploads/task_{task_id}_{preset.slug}_{idx}{_ext_from_filename(name)}",
+                        check_size=_ensure_file_size,
+                    )
+
+                # скачиваем параллельно, map сохраняет порядок tg_file_ids
+                fetched = list(_TG_POOL.map(_fetch, enumerate(tg_file_ids, start=1)))
+
+                urls = [f"{_PUBLIC_BASE}/files/{input_key}" for _, input_key, _ in fetched]
 
                 # ✅ Теперь и для GPT и для Nano используем image_urls
                 if preset.input_field == "image_urls":
@@ -334,14 +401,18 @@ def execute_task(task_id: int) -> None:
             request_id = gen.submit_network(
                 network_id=preset.provider_id,
                 files=None,
-                params=params,
+                params=dict(params),
             )
 
         else:
             raise RuntimeError(f"Unsupported provider_target={preset.provider_target}")
 
         # ---- poll ----
-        result = gen.poll(request_id, timeout_sec=settings.TASK_TIMEOUT_SEC)
+        result = gen.poll(
+            request_id,
+            timeout_sec=_TASK_TIMEOUT_SEC,
+            initial_delay=preset.poll_initial_delay_sec,
+        )
         if result.status != "success":
             raise RuntimeError(f"GenAPI failed: {result.payload}")
 
@@ -351,86 +422,67 @@ def execute_task(task_id: int) -> None:
             if t:
                 result.text = t
 
-        # ✅ Suno: берём ТОЛЬКО mp3/wav, игнорируем обложку
         file_url = result.file_url
-        all_urls = _collect_urls(result.payload)
-        if preset.slug == "suno":
-            audio_urls = [u for u in all_urls if any(ext in u.lower() for ext in (".mp3", ".wav"))]
-            if audio_urls:
-                file_url = _pick_best_url(audio_urls)
-
-        # ✅ SeedVR / general: если extractor промахнулся, выберем лучший url по расширению
-        if not file_url and all_urls:
-            file_url = _pick_best_url(all_urls)
+        # payload обходим только если url действительно нужно выбирать
+        if preset.slug == "suno" or not file_url:
+            all_urls, audio_urls = _analyze_payload(result.payload)
+
+            # ✅ Suno: берём ТОЛЬКО mp3/wav, игнорируем обложку
+            if preset.slug == "suno" and audio_urls:
+                file_url = pick_best_url(audio_urls)
+
+            # ✅ SeedVR / general: если extractor промахнулся, выберем лучший url по расширению
+            if not file_url and all_urls:
+                file_url = pick_best_url(all_urls)
         file_url_for_log = file_url
 
         # ---- store result ----
+        # Скачивание строго до финального UPDATE: как только задача стала success,
+        # бот отдаёт файл по result_file_key, и он уже должен лежать на месте.
+        # Транзакции во время скачивания нет, так что параллелить тут нечего.
         if file_url:
-            out_bytes = _download_with_retry(file_url, timeout_total=600.0)
-
-            low_url = (file_url or "").lower()
-            ext = ".bin"
-            for e in (".mp3", ".wav", ".mp4", ".mov", ".webm", ".png", ".jpg", ".jpeg", ".webp", ".gif", ".txt", ".json"):
-                if e in low_url:
-                    ext = e
-                    break
-
-            key = f"results/task_{task_id}_{preset.slug}{ext}"
-            save_bytes(key, out_bytes)
+            key = f"results/task_{task_id}_{preset.slug}{_ext_from_url(file_url)}"
+            _download_to_key(file_url, key, timeout_total=600.0)
             result_file_key_for_log = key
 
-            db.execute(
-                update(Task)
-                .where(Task.id == task_id)
-                .values(
-                    status=TaskStatus.success,
-                    result_file_key=key,
-                    result_text=result.text or "Готово ✅",
-                    updated_at=datetime.now(UTC),
-                )
-            )
-            db.commit()
-        else:
-            db.execute(
-                update(Task)
-                .where(Task.id == task_id)
-                .values(
-                    status=TaskStatus.success,
-                    result_file_key=None,
-                    result_text=result.text or "Готово ✅",
-                    updated_at=datetime.now(UTC),
-                )
-            )
-            db.commit()
-        _log_task_event(
-            event="task_success",
-            task_id=task_id,
-            preset=preset.slug,
-            file_url=file_url_for_log,
-            result_file_key=result_file_key_for_log,
-            error_message=None,
+        # единственная запись за задачу: success или failed одним UPDATE и одним commit.
+        # success пишем внутри try: если запись упала, задача уйдёт в failed ниже
+        db.execute(
+            _UPDATE_TASK,
+            {
+                "task_id": task_id,
+                "new_status": TaskStatus.success,
+                "result_key": result_file_key_for_log,
+                "result_txt": result.text or "Готово ✅",
+                "error_msg": None,
+            },
         )
+        db.commit()
+        event, error_message = "task_success", None
 
     except Exception as e:
         error_message = str(e)
         db.rollback()
         db.execute(
-            update(Task)
-            .where(Task.id == task_id)
-            .values(
-                status=TaskStatus.failed,
-                error_message=error_message,
-                updated_at=datetime.now(UTC),
-            )
+            _UPDATE_TASK,
+            {
+                "task_id": task_id,
+                "new_status": TaskStatus.failed,
+                "result_key": None,
+                "result_txt": None,
+                "error_msg": error_message,
+            },
         )
         db.commit()
-        _log_task_event(
-            event="task_failed",
-            task_id=task_id,
-            preset=preset_slug or "unknown",
-            file_url=file_url_for_log,
-            result_file_key=result_file_key_for_log,
-            error_message=error_message,
-        )
+        event = "task_failed"
     finally:
         db.close()
+
+    _log_task_event(
+        event=event,
+        task_id=task_id,
+        preset=preset_slug or "unknown",
+        file_url=file_url_for_log,
+        result_file_key=result_file_key_for_log,
+        error_message=error_message,
+    )
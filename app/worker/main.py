@@ -1,32 +1,76 @@
 ﻿import time
-from sqlalchemy import select
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 
+from sqlalchemy import select, update
+
+from app.core.config import settings
 from app.db.session import SessionLocal
-from app.db.models import Task, TaskStatus
+from app.db.models import DB_UTC_NOW, Task, TaskStatus
 from app.worker.executor import execute_task
 
-POLL_INTERVAL_SEC = 1.0
+# пустая очередь: пауза растёт от 0.1с в 1.3 раза за каждый пустой опрос, до 30с
+IDLE_POLL_MIN_SEC = 0.1
+IDLE_POLL_BACKOFF = 1.3
+IDLE_POLL_MAX_SEC = 30.0
+
+
+def _claim_queued(limit: int) -> list[tuple[int, str]]:
+    """
+    Забирает до limit задач из очереди и в той же транзакции переводит их в processing.
+    SKIP LOCKED: параллельные воркеры не ждут друг друга и не берут одну задачу дважды.
+    """
+    db = SessionLocal()
+    try:
+        rows = db.execute(
+            select(Task.id, Task.preset_slug)
+            .where(Task.status == TaskStatus.queued)
+            .order_by(Task.id.asc())
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if rows:
+            db.execute(
+                update(Task)
+                .where(Task.id.in_([task_id for task_id, _ in rows]))
+                .values(
+                    status=TaskStatus.processing,
+                    updated_at=DB_UTC_NOW,
+                    error_message=None,
+                )
+            )
+        db.commit()
+        return [tuple(r) for r in rows]
+    finally:
+        db.close()
 
 
 def main():
     print("Worker started. Scanning for queued tasks…")
+    # задачи почти целиком ждут сеть (Telegram, GenAPI), поэтому ведём несколько сразу
+    max_workers = max(1, settings.WORKER_CONCURRENCY)
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="task")
+    inflight: dict[Future, int] = {}
+    empty_streak = 0
     while True:
-        db = SessionLocal()
-        try:
-            task = db.execute(
-                select(Task)
-                .where(Task.status == TaskStatus.queued)
-                .order_by(Task.id.asc())
-                .limit(1)
-            ).scalar_one_or_none()
-        finally:
-            db.close()
-
-        if task:
-            print(f"Processing task #{task.id} preset={task.preset_slug}")
-            execute_task(task.id)
+        for fut in [f for f in inflight if f.done()]:
+            task_id = inflight.pop(fut)
+            if fut.exception() is not None:
+                print(f"Task #{task_id} crashed: {fut.exception()!r}")
+
+        capacity = max_workers - len(inflight)
+        if capacity <= 0:
+            wait(inflight, return_when=FIRST_COMPLETED)
+            continue
+
+        claimed = _claim_queued(capacity)
+        if claimed:
+            empty_streak = 0
+            for task_id, preset_slug in claimed:
+                print(f"Processing task #{task_id} preset={preset_slug}")
+                inflight[pool.submit(execute_task, task_id)] = task_id
         else:
-            time.sleep(POLL_INTERVAL_SEC)
+            time.sleep(min(IDLE_POLL_MIN_SEC * IDLE_POLL_BACKOFF ** empty_streak, IDLE_POLL_MAX_SEC))
+            empty_streak += 1
 
 
 if __name__ == "__main__":
@@ -1,37 +1,124 @@
-﻿import time
-import random
+﻿import atexit
+import time
+from typing import Callable, TypeVar
+
 import httpx
 
+from app.core.http import jitter, retry_after_seconds
+from app.storage.local import save_stream
 
-def tg_download_file(bot_token: str, file_id: str) -> tuple[str, bytes]:
+# общий клиент на процесс: getFile и скачивание тела идут по одному keep-alive
+# соединению с api.telegram.org вместо нового TLS-рукопожатия на каждый вызов.
+# http2/limits — на транспорте (при явном transport клиент их не применяет);
+# неудачное соединение транспорт повторяет сам
+_HTTP = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0),
+    ),
+    timeout=60,
+    trust_env=False,
+    follow_redirects=True,
+)
+atexit.register(_HTTP.close)
+
+
+def _retry_delay(e: Exception, delay: float) -> float:
+    # 429 от Telegram приходит с Retry-After: ждём ровно столько, иначе — backoff с jitter
+    if isinstance(e, httpx.HTTPStatusError):
+        retry_after = retry_after_seconds(e.response)
+        if retry_after is not None:
+            return retry_after
+    return jitter(delay)
+
+
+_T = TypeVar("_T")
+
+
+def _with_retries(fetch: Callable[[], _T]) -> _T:
     """
-    Возвращает (filename, bytes) по Telegram file_id через Bot API.
-    С ретраями на сетевые/5xx.
+    Общая политика повторов для скачиваний из Telegram: сетевые ошибки и 4xx/5xx,
+    до 6 попыток, Retry-After или backoff с jitter между ними.
     """
     delay = 1.0
     for attempt in range(6):
         try:
-            with httpx.Client(timeout=60, trust_env=False, follow_redirects=True) as client:
-                r = client.get(
-                    f"https://api.telegram.org/bot{bot_token}/getFile",
-                    params={"file_id": file_id},
-                )
-                r.raise_for_status()
-                js = r.json()
-                if not js.get("ok"):
-                    raise RuntimeError(f"Telegram getFile failed: {js}")
-
-                file_path = js["result"]["file_path"]
-                filename = file_path.split("/")[-1]
-
-                dl = client.get(f"https://api.telegram.org/file/bot{bot_token}/{file_path}")
-                dl.raise_for_status()
-                return filename, dl.content
-
+            return fetch()
         except (httpx.TimeoutException, httpx.NetworkError, httpx.HTTPStatusError) as e:
             if attempt == 5:
                 raise
-            time.sleep(delay * (0.85 + random.random() * 0.3))
+            time.sleep(_retry_delay(e, delay))
             delay = min(delay * 1.6, 8.0)
 
-    raise RuntimeError("Unreachable: tg_download_file retries exhausted")
+    raise RuntimeError("Unreachable: Telegram download retries exhausted")
+
+
+def _get_file_path(bot_token: str, file_id: str) -> tuple[str, int]:
+    """
+    getFile по file_id. Возвращает (file_path, file_size); file_size = 0, если Telegram его не прислал.
+    """
+    r = _HTTP.get(
+        f"https://api.telegram.org/bot{bot_token}/getFile",
+        params={"file_id": file_id},
+    )
+    r.raise_for_status()
+    js = r.json()
+    if not js.get("ok"):
+        raise RuntimeError(f"Telegram getFile failed: {js}")
+    return js["result"]["file_path"], int(js["result"].get("file_size") or 0)
+
+
+def tg_download_file(bot_token: str, file_id: str) -> tuple[str, bytes]:
+    """
+    Возвращает (filename, bytes) по Telegram file_id через Bot API.
+    С ретраями на сетевые/5xx.
+    """
+
+    def fetch() -> tuple[str, bytes]:
+        file_path, _ = _get_file_path(bot_token, file_id)
+        dl = _HTTP.get(f"https://api.telegram.org/file/bot{bot_token}/{file_path}")
+        dl.raise_for_status()
+        return file_path.split("/")[-1], dl.content
+
+    return _with_retries(fetch)
+
+
+def tg_stream_file(
+    bot_token: str,
+    file_id: str,
+    make_key: Callable[[str], str],
+    check_size: Callable[[str, int], None] | None = None,
+) -> tuple[str, str, int]:
+    """
+    Как tg_download_file, но тело файла пишется в локальное хранилище кусками,
+    без bytes-копии в памяти. make_key получает имя файла и возвращает ключ.
+    check_size(filename, size) вызывается по file_size из getFile и по ходу
+    скачивания: исключение из него прерывает запись, файл не остаётся.
+    Возвращает (filename, key, size).
+    """
+
+    def fetch() -> tuple[str, str, int]:
+        file_path, file_size = _get_file_path(bot_token, file_id)
+        filename = file_path.split("/")[-1]
+        if check_size is not None:
+            check_size(filename, file_size)
+
+        with _HTTP.stream("GET", f"https://api.telegram.org/file/bot{bot_token}/{file_path}") as dl:
+            dl.raise_for_status()
+            # размер считаем по записанным байтам: num_bytes_downloaded —
+            # это байты с провода (до распаковки), для лимита не годится
+            size = 0
+
+            def chunks():
+                nonlocal size
+                for chunk in dl.iter_bytes(chunk_size=1 << 20):
+                    size += len(chunk)
+                    if check_size is not None:
+                        check_size(filename, size)
+                    yield chunk
+
+            key = save_stream(make_key(filename), chunks())
+            return filename, key, size
+
+    return _with_retries(fetch)